@@ -2,6 +2,7 @@ import os
 
 # ENTSOE
 SECURITY_TOKEN = os.environ.get("SECURITY_TOKEN")
+ENTSOE_MAX_CONCURRENT_REQUESTS = int(os.environ.get("ENTSOE_MAX_CONCURRENT_REQUESTS", 4))
 
 # Database
 AZURE_PG_HOST = os.environ.get("AZURE_PG_HOST")
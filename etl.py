@@ -1,14 +1,24 @@
+import csv
+import io
 import os
+import sys
+import threading
+from collections import deque
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 from datetime import datetime, timedelta, timezone
-import xml.etree.ElementTree as ET
-from psycopg2.extras import execute_values
+from zoneinfo import ZoneInfo
+from lxml import etree
 import psycopg2
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 import logging
 import smtplib
 from email.mime.text import MIMEText
-import pytz
 from config import *
 
 # --- Logging ---
@@ -43,156 +53,356 @@ germany_control_areas = {
 }
 germany_bidding_zone = "10Y1001A1001A82H"  # DE-LU BZN
 
-# --- Helper to compute interval ---
-def get_time_interval(start_time, resolution, position):
-    if resolution == "PT15M":
-        delta = timedelta(minutes=15)
-    elif resolution == "PT30M":
-        delta = timedelta(minutes=30)
-    else:
-        delta = timedelta(hours=1)
-    point_start = start_time + delta * (position - 1)
-    point_end = point_start + delta
-    return point_start, point_end
+# --- Time zones (resolved once) ---
+_UTC = timezone.utc
+_CET = ZoneInfo("Europe/Berlin")
 
-# --- Unified ETL function for Balancing Reserves ---
-def fetch_and_store_data(country_name, control_area, start_dt, end_dt):
-    try:
-        # Attach UTC explicitly
-        start_dt_naive = start_dt.replace(tzinfo=None)
-        end_dt_naive = end_dt.replace(tzinfo=None)
-        utc = pytz.utc
-        start_dt = utc.localize(start_dt_naive)
-        end_dt = utc.localize(end_dt_naive)
-        cet = pytz.timezone("Europe/Berlin")
-        start_dt_cet = start_dt.astimezone(cet)
-        end_dt_cet = end_dt.astimezone(cet)
-        period_start = start_dt_cet.strftime("%Y%m%d%H%M")
-        period_end = end_dt_cet.strftime("%Y%m%d%H%M")
-        process_types = ["A51", "A52", "A47", "A46"]
-        data = []
-
-        for process_type in process_types:
+# --- Shared HTTP session (keeps TLS connections alive across calls) ---
+# Transient ENTSOE errors (429/5xx) are retried with exponential backoff, honouring Retry-After;
+# the last response is returned rather than raised so raise_for_status() still reports it
+_RETRY = Retry(total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+               respect_retry_after_header=True, raise_on_status=False)
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=_RETRY))
+_SESSION.headers.update({"Accept-Encoding": "gzip, deflate"})
+# (connect, read) timeouts so a stalled connection can't hang a worker forever
+HTTP_TIMEOUT = (5, 60)
+# Caps in-flight ENTSOE requests across all worker threads
+_API_SEMAPHORE = threading.BoundedSemaphore(ENTSOE_MAX_CONCURRENT_REQUESTS)
+
+# --- Database ---
+_DB_POOL = None
+_DB_POOL_LOCK = threading.Lock()
+
+# Natural key of each table: (unique index, key columns). NULLs compare equal via COALESCE
+NATURAL_KEYS = {
+    "entsoe_load_data": ("ux_entsoe_load_data",
+                         ("country", "control_area", "reserve_type", "reserve_source", "direction", "delivery_period")),
+    "day_ahead_prices": ("ux_day_ahead_prices", ("country", "bidding_zone", "resolution", "delivery_period")),
+}
+
+def natural_key_sql(key):
+    return sql.SQL(", ").join(sql.SQL("COALESCE({}, '')").format(sql.Identifier(col)) for col in key)
+
+# Rows beyond the first in each natural-key group (one hash aggregate, no self-join)
+def count_key_duplicates(cursor, table, key):
+    cursor.execute(sql.SQL("SELECT COALESCE(sum(n - 1), 0) FROM (SELECT count(*) AS n FROM {} GROUP BY {}) g").format(
+        sql.Identifier(table), natural_key_sql(key)))
+    return int(cursor.fetchone()[0])
+
+def ensure_schema(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS entsoe_load_data (
+        delivery_period TEXT,
+        reserve_type TEXT,
+        reserve_source TEXT,
+        direction TEXT,
+        volume DOUBLE PRECISION,
+        price DOUBLE PRECISION,
+        price_type TEXT,
+        type_of_product TEXT,
+        time_horizon TEXT
+    )
+    """)
+    conn.commit()
+
+    # --- Add missing columns (single idempotent statement, PG 9.6+) ---
+    cursor.execute("""
+    ALTER TABLE entsoe_load_data
+        ADD COLUMN IF NOT EXISTS country TEXT,
+        ADD COLUMN IF NOT EXISTS control_area TEXT,
+        ADD COLUMN IF NOT EXISTS inserted_at TIMESTAMP DEFAULT now()
+    """)
+    conn.commit()
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS day_ahead_prices (
+        delivery_period TEXT,
+        price_eur_mwh DOUBLE PRECISION,
+        resolution TEXT,
+        bidding_zone TEXT,
+        country TEXT,
+        inserted_at TIMESTAMP DEFAULT now()
+    )
+    """)
+    conn.commit()
+
+    # --- Natural keys, so re-running a day inserts nothing twice (ON CONFLICT DO NOTHING) ---
+    # Startup never deletes data: if a table still holds rows that share a key (left by
+    # earlier re-runs), its index is skipped until `python etl.py dedupe` has been run
+    for table, (index_name, key) in NATURAL_KEYS.items():
+        cursor.execute("SELECT to_regclass(%s)", (index_name,))
+        if cursor.fetchone()[0] is not None:
+            continue
+        duplicates = count_key_duplicates(cursor, table, key)
+        if duplicates:
+            logging.warning(f"{table} has {duplicates} rows repeating its natural key; {index_name} not built. "
+                            f"Run `python etl.py dedupe` to remove duplicate rows and build it")
+            continue
+        cursor.execute(sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})").format(
+            sql.Identifier(index_name), sql.Identifier(table), natural_key_sql(key)))
+        conn.commit()
+    cursor.close()
+
+# Connections are opened once per process and shared by all ETL calls;
+# the schema is checked the first time the pool is created.
+# The loader is idempotent (ON CONFLICT DO NOTHING + checkpoint), so its sessions run with
+# synchronous_commit=off: a commit returns once WAL is buffered instead of waiting for fsync
+def get_conn():
+    global _DB_POOL
+    with _DB_POOL_LOCK:
+        if _DB_POOL is None or _DB_POOL.closed:
+            _DB_POOL = ThreadedConnectionPool(1, 16, dbname=AZURE_PG_DB, user=AZURE_PG_USER,
+                                              password=AZURE_PG_PASSWORD, host=AZURE_PG_HOST,
+                                              port=5432, sslmode='require',
+                                              options="-c synchronous_commit=off")
+            conn = _DB_POOL.getconn()
             try:
-                API_URL = "https://web-api.tp.entsoe.eu/api"
-                PARAMS = {
-                    "securityToken": SECURITY_TOKEN,
-                    "documentType": "A81",
-                    "businessType": "B95",
-                    "processType": process_type,
-                    "Type_MarketAgreement.Type": "A01",
-                    "controlArea_Domain": control_area,
-                    "periodStart": period_start,
-                    "periodEnd": period_end
-                }
-                response = requests.get(API_URL, params=PARAMS)
-                response.raise_for_status()
-                root = ET.fromstring(response.content)
-                ns = {'ns': root.tag.split('}')[0].strip('{')}
-                reserve_map = {"A51": "AFRR", "A52": "FCR", "A47": "MFRR", "A46": "RR"}
-                reserve_source_map = {"A04": "Generation", "A05": "Load", "A03": "Mixed"}
-                direction_map = {"A01": "Up", "A02": "Down", "A03": "Up and Down (Symmetric)"}
-
-                for ts in root.findall(".//ns:TimeSeries", ns):
-                    reserve_type = reserve_map.get(process_type, process_type)
-                    reserve_source1 = ts.find("ns:mktPSRType.psrType", ns)
-                    reserve_source = reserve_source_map.get(reserve_source1.text, reserve_source1.text) if reserve_source1 is not None else None
-                    direction_code = ts.find("ns:flowDirection.direction", ns)
-                    direction = direction_map.get(direction_code.text, direction_code.text) if direction_code is not None else None
-                    product_type = "Standard"
-                    time_horizon = "Daily"
-                    if direction in ("Up","Down"):
-                        price_type = "Average"
-                    else:
-                        price_type = "Marginal"
-                    for period in ts.findall("ns:Period", ns):
-                        start_time_str = period.find("ns:timeInterval/ns:start", ns).text
-                        start_time = datetime.strptime(start_time_str, "%Y-%m-%dT%H:%MZ").replace(tzinfo=timezone.utc)
-                        resolution = period.find("ns:resolution", ns).text
-                        for point in period.findall("ns:Point", ns):
-                            quantity_el = point.find("ns:quantity", ns)
-                            price_el = point.find("ns:procurement_Price.amount", ns)
-                            quantity = float(quantity_el.text) if quantity_el is not None else None
-                            price = float(price_el.text) if price_el is not None else None
-                            position_el = point.find("ns:position", ns)
-                            position = int(position_el.text) if position_el is not None else 1
-                            point_start, point_end = get_time_interval(start_time, resolution, position)
-                            delivery_period = f"{point_start.strftime('%d.%m.%Y %H:%M')} - {point_end.strftime('%d.%m.%Y %H:%M')} (UTC)"
-                            data.append({
-                                "delivery_period": delivery_period,
-                                "reserve_type": reserve_type,
-                                "reserve_source": reserve_source,
-                                "direction": direction,
-                                "volume": quantity,
-                                "price": price,
-                                "price_type": price_type,
-                                "type_of_product": product_type,
-                                "time_horizon": time_horizon,
-                                "country": country_name,
-                                "control_area": control_area
-                            })
-            except Exception as inner_e:
-                logging.error(f"Failed to fetch {process_type}: {inner_e}", exc_info=True)
-
-        if not data:
-            logging.warning(f"No data for {country_name} {control_area} {period_start} - {period_end}")
+                ensure_schema(conn)
+            finally:
+                _DB_POOL.putconn(conn)
+    return _DB_POOL.getconn()
+
+def put_conn(conn):
+    _DB_POOL.putconn(conn, close=bool(conn.closed))
+
+def close_db_pool():
+    if _DB_POOL is not None and not _DB_POOL.closed:
+        _DB_POOL.closeall()
+
+# Column order of each target table, with the Postgres element type used to cast
+# the per-column arrays of the UNNEST insert
+ENTSOE_COLUMN_TYPES = {
+    "delivery_period": "text", "reserve_type": "text", "reserve_source": "text", "direction": "text",
+    "volume": "float8", "price": "float8", "price_type": "text", "type_of_product": "text",
+    "time_horizon": "text", "country": "text", "control_area": "text"
+}
+DAYAHEAD_COLUMN_TYPES = {
+    "delivery_period": "text", "price_eur_mwh": "float8", "resolution": "text",
+    "bidding_zone": "text", "country": "text"
+}
+
+# Load statements are composed once per table with psycopg2.sql (identifiers quoted),
+# instead of being re-concatenated for every batch
+def build_load_statements(table, column_types):
+    target = sql.Identifier(table)
+    stage = sql.Identifier(f"{table}_stage")
+    columns = sql.SQL(", ").join(map(sql.Identifier, column_types))
+    arrays = sql.SQL(", ").join(sql.SQL(f"%s::{pg_type}[]") for pg_type in column_types.values())
+    return {
+        "table": table,
+        "create_stage": sql.SQL("CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS) "
+                                "ON COMMIT DELETE ROWS").format(stage, target),
+        "copy": sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT CSV)").format(stage, columns),
+        "merge": sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT DO NOTHING").format(
+            target, columns, columns, stage),
+        "unnest": sql.SQL("INSERT INTO {} ({}) SELECT * FROM UNNEST({}) ON CONFLICT DO NOTHING").format(
+            target, columns, arrays)
+    }
+
+ENTSOE_SQL = build_load_statements("entsoe_load_data", ENTSOE_COLUMN_TYPES)
+DAYAHEAD_SQL = build_load_statements("day_ahead_prices", DAYAHEAD_COLUMN_TYPES)
+_COPY_SUPPORTED = True
+
+# Bulk-load row tuples (in the table's column order) with COPY; if the server or role
+# refuses COPY, fall back (for the rest of the run) to one INSERT ... SELECT * FROM UNNEST(arrays).
+# COPY has no ON CONFLICT, so it goes through a per-session staging table
+def store_rows(conn, rows, statements):
+    global _COPY_SUPPORTED
+    cursor = conn.cursor()
+    if _COPY_SUPPORTED:
+        try:
+            cursor.execute(statements["create_stage"])
+            # csv writes None as an unquoted empty field, which is COPY's CSV NULL
+            buf = io.StringIO()
+            csv.writer(buf, lineterminator="\n").writerows(rows)
+            buf.seek(0)
+            cursor.copy_expert(statements["copy"], buf)
+            cursor.execute(statements["merge"])
+            conn.commit()
+            cursor.close()
             return
+        except (psycopg2.errors.InsufficientPrivilege, psycopg2.errors.FeatureNotSupported) as e:
+            conn.rollback()
+            logging.warning(f"COPY into {statements['table']} unavailable, falling back to UNNEST inserts: {e}")
+            _COPY_SUPPORTED = False
 
-        df = pd.DataFrame(data)
-        conn = psycopg2.connect(dbname=AZURE_PG_DB, user=AZURE_PG_USER, password=AZURE_PG_PASSWORD,
-                                host=AZURE_PG_HOST, port=5432, sslmode='require')
-        cursor = conn.cursor()
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS entsoe_load_data (
-            delivery_period TEXT,
-            reserve_type TEXT,
-            reserve_source TEXT,
-            direction TEXT,
-            volume DOUBLE PRECISION,
-            price DOUBLE PRECISION,
-            price_type TEXT,
-            type_of_product TEXT,
-            time_horizon TEXT
-        )
-        """)
-        conn.commit()
+    # One array per column; psycopg2 adapts Python lists to PG arrays
+    arrays = [list(column) for column in zip(*rows)]
+    cursor.execute(statements["unnest"], arrays)
+    conn.commit()
+    cursor.close()
 
-        # --- Add missing columns ---
-        required_columns = {"country": "TEXT", "control_area": "TEXT", "inserted_at": "TIMESTAMP DEFAULT now()"}
-        for col, col_type in required_columns.items():
-            cursor.execute(f"""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (SELECT 1 FROM information_schema.columns 
-                               WHERE table_name='entsoe_load_data' AND column_name='{col}') THEN
-                    ALTER TABLE entsoe_load_data ADD COLUMN {col} {col_type};
-                END IF;
-            END
-            $$;
-            """)
-        conn.commit()
+# One COPY (and one commit) per table for everything accumulated in a batch
+def flush_rows(conn, rows_entsoe, rows_dayahead):
+    if rows_entsoe:
+        store_rows(conn, rows_entsoe, ENTSOE_SQL)
+    if rows_dayahead:
+        store_rows(conn, rows_dayahead, DAYAHEAD_SQL)
 
-        records = df.to_dict("records")
-        columns = df.columns.tolist()
-        values = [[r.get(col) for col in columns] for r in records]
-        execute_values(cursor,
-                       f"INSERT INTO entsoe_load_data ({', '.join(columns)}) VALUES %s",
-                       values)
-        conn.commit()
-        cursor.close()
-        conn.close()
-        logging.info(f"Inserted {len(df)} rows for {country_name} {period_start} - {period_end}")
+# --- XML tags streamed by iterparse ---
+# Matched with a {*} namespace wildcard: ENTSOE bumps document versions
+# (e.g. publicationdocument:7:0 -> 7:3), so the namespace is never hard-coded
+BALANCING_TAGS = ("{*}TimeSeries", "{*}mktPSRType.psrType", "{*}flowDirection.direction",
+                  "{*}Period", "{*}start", "{*}resolution", "{*}Point")
+DAYAHEAD_TAGS = ("{*}TimeSeries", "{*}Period", "{*}start", "{*}resolution", "{*}Point")
+
+# --- ENTSOE code lookups ---
+PROCESS_TYPES = ("A51", "A52", "A47", "A46")
+RESERVE_MAP = {"A51": "AFRR", "A52": "FCR", "A47": "MFRR", "A46": "RR"}
+RESERVE_SOURCE_MAP = {"A04": "Generation", "A05": "Load", "A03": "Mixed"}
+DIRECTION_MAP = {"A01": "Up", "A02": "Down", "A03": "Up and Down (Symmetric)"}
+
+# --- Delivery period helpers ---
+RESOLUTION_MINUTES = {"PT15M": 15, "PT30M": 30}  # anything else is hourly
+
+# ENTSOE timestamps are always "YYYY-MM-DDTHH:MMZ"; slicing is much cheaper than strptime
+def _parse_entsoe_ts(s):
+    return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), tzinfo=_UTC)
+
+# Rows carry the raw (period_start epoch, resolution minutes, position) triple while
+# parsing. The same intervals recur across TSOs, process types and directions,
+# so each formatted delivery_period is built once and then served from the cache
+@lru_cache(maxsize=8192)
+def format_delivery_period(period_start_ts, resolution_minutes, position):
+    point_start = datetime.fromtimestamp(period_start_ts + (position - 1) * resolution_minutes * 60, _UTC)
+    point_end = point_start + timedelta(minutes=resolution_minutes)
+    return f"{point_start.strftime('%d.%m.%Y %H:%M')} - {point_end.strftime('%d.%m.%Y %H:%M')} (UTC)"
+
+# ENTSOE answers some empty queries with HTTP 400 and an Acknowledgement_MarketDocument
+# whose reason is "No matching data found"; that is an empty result, not a failure
+def _is_no_data_response(response):
+    return response.status_code == 400 and b"No matching data found" in response.content
+
+# --- Balancing Reserves, one process type (returns entsoe_load_data rows; raises on failure) ---
+def fetch_reserves(country_name, control_area, process_type, start_dt, end_dt):
+    # Attach UTC explicitly (the wall-clock time is taken as UTC, as before)
+    period_start = start_dt.replace(tzinfo=_UTC).astimezone(_CET).strftime("%Y%m%d%H%M")
+    period_end = end_dt.replace(tzinfo=_UTC).astimezone(_CET).strftime("%Y%m%d%H%M")
+
+    # One list per column (structure of arrays) instead of one dict per row
+    col_period_start, col_resolution_minutes, col_position = [], [], []
+    col_reserve_source, col_direction, col_volume, col_price, col_price_type = [], [], [], [], []
+    try:
+        API_URL = "https://web-api.tp.entsoe.eu/api"
+        PARAMS = {
+            "securityToken": SECURITY_TOKEN,
+            "documentType": "A81",
+            "businessType": "B95",
+            "processType": process_type,
+            "Type_MarketAgreement.Type": "A01",
+            "controlArea_Domain": control_area,
+            "periodStart": period_start,
+            "periodEnd": period_end
+        }
+        reserve_type = RESERVE_MAP.get(process_type, process_type)
+
+        with _API_SEMAPHORE, _SESSION.get(API_URL, params=PARAMS, stream=True, timeout=HTTP_TIMEOUT) as response:
+            if _is_no_data_response(response):
+                logging.warning(f"No matching data for {process_type} {country_name} {period_start} - {period_end}")
+                return []
+            response.raise_for_status()
+            # Parse straight off the (transparently gunzipped) socket stream
+            response.raw.decode_content = True
+            # Stream the document: TimeSeries/Period attributes precede their Points,
+            # so track them as state and emit one row per Point end event
+            reserve_source = direction = None
+            price_type = "Marginal"
+            period_start_ts = resolution_minutes = start_time_str = None
+            context = etree.iterparse(response.raw, events=("end",), tag=BALANCING_TAGS)
+            for _, elem in context:
+                tag = elem.tag.rpartition("}")[2]
+                if tag == "Point":
+                    # Usual layout is <position/><quantity/>[<procurement_Price.amount/>]:
+                    # read it by index, and only scan the children by tag if it differs
+                    n = len(elem)
+                    if (n in (2, 3) and elem[0].tag.endswith("}position")
+                            and elem[1].tag.endswith("}quantity")
+                            and (n == 2 or elem[2].tag.endswith("}procurement_Price.amount"))):
+                        position = int(elem[0].text)
+                        quantity = float(elem[1].text)
+                        price = float(elem[2].text) if n == 3 else None
+                    else:
+                        quantity = price = None
+                        position = 1
+                        for child in elem:
+                            child_tag = child.tag.rpartition("}")[2]
+                            if child_tag == "position":
+                                position = int(child.text)
+                            elif child_tag == "quantity":
+                                quantity = float(child.text)
+                            elif child_tag == "procurement_Price.amount":
+                                price = float(child.text)
+                    col_period_start.append(period_start_ts)
+                    col_resolution_minutes.append(resolution_minutes)
+                    col_position.append(position)
+                    col_reserve_source.append(reserve_source)
+                    col_direction.append(direction)
+                    col_volume.append(quantity)
+                    col_price.append(price)
+                    col_price_type.append(price_type)
+                    elem.clear()
+                elif tag == "start":
+                    start_time_str = elem.text
+                elif tag == "resolution":
+                    # timeInterval/start of the enclosing Period has just been seen
+                    resolution_minutes = RESOLUTION_MINUTES.get(elem.text, 60)
+                    start_time = _parse_entsoe_ts(start_time_str)
+                    period_start_ts = int(start_time.timestamp())
+                elif tag == "mktPSRType.psrType":
+                    reserve_source = RESERVE_SOURCE_MAP.get(elem.text, elem.text)
+                elif tag == "flowDirection.direction":
+                    direction = DIRECTION_MAP.get(elem.text, elem.text)
+                    price_type = "Average" if direction in ("Up", "Down") else "Marginal"
+                elif tag == "Period":
+                    elem.getparent().remove(elem)
+                elif tag == "TimeSeries":
+                    reserve_source = direction = None
+                    price_type = "Marginal"
+                    elem.getparent().remove(elem)
+    except Exception as e:
+        logging.error(f"Failed to fetch {process_type} for {country_name} {period_start} - {period_end}: {e}", exc_info=True)
+        raise
+
+    # Rows in entsoe_load_data column order; constant columns are repeated lazily
+    col_delivery_period = map(format_delivery_period, col_period_start, col_resolution_minutes, col_position)
+    return list(zip(col_delivery_period, repeat(reserve_type), col_reserve_source, col_direction,
+                    col_volume, col_price, col_price_type,
+                    repeat("Standard"), repeat("Daily"), repeat(country_name), repeat(control_area)))
+
+# --- Unified fetch function for Balancing Reserves (daily load; returns entsoe_load_data rows) ---
+# A failed process type is logged and skipped so the others still load
+def fetch_data(country_name, control_area, start_dt, end_dt):
+    try:
+        period_start = start_dt.replace(tzinfo=_UTC).astimezone(_CET).strftime("%Y%m%d%H%M")
+        period_end = end_dt.replace(tzinfo=_UTC).astimezone(_CET).strftime("%Y%m%d%H%M")
+
+        # The four process types are independent requests; fetch them concurrently
+        def fetch_one(process_type):
+            try:
+                return fetch_reserves(country_name, control_area, process_type, start_dt, end_dt)
+            except Exception:
+                return []
+
+        with ThreadPoolExecutor(max_workers=len(PROCESS_TYPES)) as executor:
+            values = [row for rows in executor.map(fetch_one, PROCESS_TYPES) for row in rows]
+
+        if not values:
+            logging.warning(f"No data for {country_name} {control_area} {period_start} - {period_end}")
+            return []
+        logging.info(f"Fetched {len(values)} rows for {country_name} {period_start} - {period_end}")
+        return values
     except Exception as e:
         logging.error(f"ETL failed for {country_name} {period_start} - {period_end}: {e}", exc_info=True)
         send_email_alert("ENTSOE ETL Failed", f"{country_name} {period_start}-{period_end}\n{e}")
         raise
 
-# --- Unified ETL function for Day-ahead ---
-def fetch_and_store_dayahead_prices(country_name, bidding_zone, start_dt, end_dt):
+# --- Unified fetch function for Day-ahead (returns day_ahead_prices rows) ---
+def fetch_dayahead_prices(country_name, bidding_zone, start_dt, end_dt):
     try:
-        cet = pytz.timezone("Europe/Berlin")
-        period_start = start_dt.astimezone(cet).strftime("%Y%m%d%H%M")
-        period_end = end_dt.astimezone(cet).strftime("%Y%m%d%H%M")
+        period_start = start_dt.astimezone(_CET).strftime("%Y%m%d%H%M")
+        period_end = end_dt.astimezone(_CET).strftime("%Y%m%d%H%M")
 
         API_URL = "https://web-api.tp.entsoe.eu/api"
         PARAMS = {
@@ -205,94 +415,188 @@ def fetch_and_store_dayahead_prices(country_name, bidding_zone, start_dt, end_dt
             "contract_MarketAgreement.type": "A01"
         }
 
-        response = requests.get(API_URL, params=PARAMS)
-        response.raise_for_status()
-        root = ET.fromstring(response.content)
-        ns = {'ns': root.tag.split('}')[0].strip('{')}
-        data = []
-
-        for ts in root.findall(".//ns:TimeSeries", ns):
-            for period in ts.findall(".//ns:Period", ns):
-                start_time_str = period.find("ns:timeInterval/ns:start", ns).text
-                start_time_utc = datetime.strptime(start_time_str, "%Y-%m-%dT%H:%MZ").replace(tzinfo=timezone.utc)
-                resolution = period.find("ns:resolution", ns).text
-                for point in period.findall("ns:Point", ns):
-                    position_el = point.find("ns:position", ns)
-                    price_el = point.find("ns:price.amount", ns)
-                    if position_el is None or price_el is None:
+        col_period_start, col_resolution_minutes, col_position, col_price, col_resolution = [], [], [], [], []
+        with _API_SEMAPHORE, _SESSION.get(API_URL, params=PARAMS, stream=True, timeout=HTTP_TIMEOUT) as response:
+            if _is_no_data_response(response):
+                logging.warning(f"No matching Day-ahead data for {country_name} {period_start} - {period_end}")
+                return []
+            response.raise_for_status()
+            # Parse straight off the (transparently gunzipped) socket stream
+            response.raw.decode_content = True
+            period_start_ts = resolution = resolution_minutes = start_time_str = None
+            context = etree.iterparse(response.raw, events=("end",), tag=DAYAHEAD_TAGS)
+            for _, elem in context:
+                tag = elem.tag.rpartition("}")[2]
+                if tag == "Point":
+                    # Usual layout is <position/><price.amount/>; scan by tag only if it differs
+                    if len(elem) == 2 and elem[0].tag.endswith("}position") and elem[1].tag.endswith("}price.amount"):
+                        position = int(elem[0].text)
+                        price = float(elem[1].text)
+                    else:
+                        position = price = None
+                        for child in elem:
+                            child_tag = child.tag.rpartition("}")[2]
+                            if child_tag == "position":
+                                position = int(child.text)
+                            elif child_tag == "price.amount":
+                                price = float(child.text)
+                    elem.clear()
+                    if position is None or price is None:
                         continue
-                    position = int(position_el.text)
-                    price = float(price_el.text)
-                    mtu_start, mtu_end = get_time_interval(start_time_utc, resolution, position)
-                    delivery_period = f"{mtu_start.strftime('%d.%m.%Y %H:%M')} - {mtu_end.strftime('%d.%m.%Y %H:%M')} (UTC)"
-                    data.append({
-                        "delivery_period": delivery_period,
-                        "price_eur_mwh": price,
-                        "resolution": resolution,
-                        "bidding_zone": bidding_zone,
-                        "country": country_name
-                    })
-
-        if not data:
+                    col_period_start.append(period_start_ts)
+                    col_resolution_minutes.append(resolution_minutes)
+                    col_position.append(position)
+                    col_price.append(price)
+                    col_resolution.append(resolution)
+                elif tag == "start":
+                    start_time_str = elem.text
+                elif tag == "resolution":
+                    resolution = elem.text
+                    resolution_minutes = RESOLUTION_MINUTES.get(resolution, 60)
+                    start_time_utc = _parse_entsoe_ts(start_time_str)
+                    period_start_ts = int(start_time_utc.timestamp())
+                elif tag in ("Period", "TimeSeries"):
+                    elem.getparent().remove(elem)
+
+        if not col_position:
             logging.warning(f"No Day-ahead data for {country_name} {period_start} - {period_end}")
-            return
+            return []
 
-        df = pd.DataFrame(data)
-        conn = psycopg2.connect(dbname=AZURE_PG_DB, user=AZURE_PG_USER, password=AZURE_PG_PASSWORD,
-                                host=AZURE_PG_HOST, port=5432, sslmode='require')
-        cursor = conn.cursor()
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS day_ahead_prices (
-            delivery_period TEXT,
-            price_eur_mwh DOUBLE PRECISION,
-            resolution TEXT,
-            bidding_zone TEXT,
-            country TEXT,
-            inserted_at TIMESTAMP DEFAULT now()
-        )
-        """)
-        conn.commit()
-        records = df.to_dict("records")
-        columns = df.columns.tolist()
-        values = [[r.get(col) for col in columns] for r in records]
-        execute_values(cursor,
-                       f"INSERT INTO day_ahead_prices ({', '.join(columns)}) VALUES %s",
-                       values)
-        conn.commit()
-        cursor.close()
-        conn.close()
-        logging.info(f"Inserted {len(df)} Day-ahead rows for {country_name} {period_start} - {period_end}")
+        # Rows in day_ahead_prices column order
+        col_delivery_period = map(format_delivery_period, col_period_start, col_resolution_minutes, col_position)
+        values = list(zip(col_delivery_period, col_price, col_resolution, repeat(bidding_zone), repeat(country_name)))
+        logging.info(f"Fetched {len(values)} Day-ahead rows for {country_name} {period_start} - {period_end}")
+        return values
     except Exception as e:
         logging.error(f"Day-ahead ETL failed for {country_name} {period_start} - {period_end}: {e}", exc_info=True)
         send_email_alert("ENTSOE Day-ahead ETL Failed", f"{country_name} {period_start}-{period_end}\n{e}")
         raise
 
-# --- Day-wise Historical Loader ---
+# --- Store one batch of fetched rows ---
+def store_batch(rows_entsoe, rows_dayahead, label):
+    try:
+        conn = get_conn()
+        try:
+            flush_rows(conn, rows_entsoe, rows_dayahead)
+        finally:
+            put_conn(conn)
+        logging.info(f"Inserted {len(rows_entsoe)} entsoe_load_data and {len(rows_dayahead)} day_ahead_prices rows for {label}")
+    except Exception as e:
+        logging.error(f"Storing rows failed for {label}: {e}", exc_info=True)
+        send_email_alert("ENTSOE ETL Failed", f"{label}\n{e}")
+        raise
+
+def fetch_and_store_data(country_name, control_area, start_dt, end_dt):
+    rows = fetch_data(country_name, control_area, start_dt, end_dt)
+    if rows:
+        store_batch(rows, [], f"{country_name} {start_dt:%Y-%m-%d %H:%M} - {end_dt:%Y-%m-%d %H:%M}")
+
+def fetch_and_store_dayahead_prices(country_name, bidding_zone, start_dt, end_dt):
+    rows = fetch_dayahead_prices(country_name, bidding_zone, start_dt, end_dt)
+    if rows:
+        store_batch([], rows, f"{country_name} {start_dt:%Y-%m-%d %H:%M} - {end_dt:%Y-%m-%d %H:%M}")
+
+# --- Historical sources, fetched for every day: (target table, fetch function, leading args) ---
+# Each fetch is called as fetch(*args, day, next_day); its rows are buffered under the table key.
+# Balancing reserves are one source per (TSO, process type), so the backfill pool dispatches
+# every request itself; a failed fetch keeps its day (and all later ones) un-checkpointed
+HISTORICAL_SOURCES = [
+    ("entsoe", fetch_reserves, (f"Germany-{tso_name}", control_area, process_type))
+    for tso_name, control_area in germany_control_areas.items()
+    for process_type in PROCESS_TYPES
+] + [("dayahead", fetch_dayahead_prices, ("BZN|DE-LU", germany_bidding_zone))]
+
+# --- Historical batching: rows are buffered across days and flushed once this many are pending (~10MB of CSV) ---
+HISTORICAL_FLUSH_ROWS = 100_000
+
+# --- Historical checkpoint (last fully loaded day, "YYYY-MM-DD") ---
+HISTORICAL_START = datetime(2024, 1, 1, tzinfo=_UTC)
+CHECKPOINT_FILE = ".last_historical_run"
+
+def read_checkpoint():
+    try:
+        with open(CHECKPOINT_FILE) as f:
+            # Older runs stored a "YYYY-MM-DD HH:MM:SS" completion stamp; its date works as well
+            return datetime.strptime(f.read().strip()[:10], "%Y-%m-%d").replace(tzinfo=_UTC)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_checkpoint(day):
+    tmp_file = CHECKPOINT_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write(day.strftime("%Y-%m-%d"))
+    os.replace(tmp_file, CHECKPOINT_FILE)
+
+# --- Day-wise Historical Loader (resumes after the checkpointed day) ---
 def historical_load_daywise():
-    start_date = datetime(2024, 1, 1, tzinfo=timezone.utc)
-    now_utc = datetime.now(timezone.utc)
-    cet = pytz.timezone("Europe/Berlin")
-    yesterday_22_cet = now_utc.astimezone(cet).replace(hour=22, minute=0, second=0, microsecond=0)
-    if now_utc >= yesterday_22_cet.astimezone(timezone.utc):
+    last_loaded = read_checkpoint()
+    start_date = last_loaded + timedelta(days=1) if last_loaded else HISTORICAL_START
+    now_utc = datetime.now(_UTC)
+    yesterday_22_cet = now_utc.astimezone(_CET).replace(hour=22, minute=0, second=0, microsecond=0)
+    if now_utc >= yesterday_22_cet.astimezone(_UTC):
         historical_end = yesterday_22_cet
     else:
         historical_end = yesterday_22_cet - timedelta(days=1)
 
+    days = []
     current_day = start_date
-    while current_day < historical_end.astimezone(timezone.utc):
-        next_day = current_day + timedelta(days=1)
-        logging.info(f"Fetching historical data for {current_day.strftime('%Y-%m-%d')}")
-        for tso_name, control_area in germany_control_areas.items():
-            fetch_and_store_data(f"Germany-{tso_name}", control_area, current_day, next_day)
-        fetch_and_store_dayahead_prices("BZN|DE-LU", germany_bidding_zone, current_day, next_day)
-        current_day = next_day
+    while current_day < historical_end.astimezone(_UTC):
+        days.append(current_day)
+        current_day += timedelta(days=1)
+
+    if not days:
+        logging.info("Historical backfill is up to date.")
+        return
+    logging.info(f"Running historical backfill from {start_date.strftime('%Y-%m-%d')}...")
+
+    # Every (day, source) fetch is dispatched to the pool up front, so requests for different
+    # days, TSOs and process types are continuously in flight (capped by _API_SEMAPHORE) and workers never
+    # wait on the database: this thread is the single writer. Results are collected day by
+    # day in date order, so the checkpoint only ever advances past complete, flushed days.
+    # A failed fetch (already logged by the fetch function) is recorded and the backfill
+    # carries on; the checkpoint stops before the first failed day so the next run retries it
+    pending = {"entsoe": [], "dayahead": []}
+    first_day = days[0]
+    failed = []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        try:
+            # Each day's futures are popped once consumed, so their rows are freed after the flush
+            day_futures = deque(
+                (day, [(table, args, executor.submit(fetch, *args, day, day + timedelta(days=1)))
+                       for table, fetch, args in HISTORICAL_SOURCES])
+                for day in days
+            )
+            while day_futures:
+                day, futures = day_futures.popleft()
+                for table, args, future in futures:
+                    try:
+                        pending[table].extend(future.result())
+                    except Exception as e:
+                        failed.append((day, args, e))
+                if len(pending["entsoe"]) + len(pending["dayahead"]) >= HISTORICAL_FLUSH_ROWS or day == days[-1]:
+                    store_batch(pending["entsoe"], pending["dayahead"],
+                                f"{first_day.strftime('%Y-%m-%d')} - {day.strftime('%Y-%m-%d')}")
+                    if not failed:
+                        write_checkpoint(day)
+                    elif failed[0][0] > first_day:
+                        write_checkpoint(failed[0][0] - timedelta(days=1))
+                    pending = {"entsoe": [], "dayahead": []}
+                    first_day = day + timedelta(days=1)
+        except Exception:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+    if failed:
+        logging.error(f"Historical backfill incomplete: {len(failed)} fetches failed, "
+                      f"checkpoint held before {failed[0][0].strftime('%Y-%m-%d')}")
+        send_email_alert("ENTSOE Historical ETL Incomplete", "\n".join(
+            f"{day.strftime('%Y-%m-%d')} {' '.join(args)}: {e}" for day, args, e in failed))
 
 # --- Daily Loader ---
 def daily_load():
-    now_utc = datetime.now(timezone.utc)
-    cet = pytz.timezone("Europe/Berlin")
-    today_22_cet = now_utc.astimezone(cet).replace(hour=22, minute=0, second=0, microsecond=0)
-    if now_utc >= today_22_cet.astimezone(timezone.utc):
+    now_utc = datetime.now(_UTC)
+    today_22_cet = now_utc.astimezone(_CET).replace(hour=22, minute=0, second=0, microsecond=0)
+    if now_utc >= today_22_cet.astimezone(_UTC):
         period_end = today_22_cet
     else:
         period_end = today_22_cet - timedelta(days=1)
@@ -302,19 +606,66 @@ def daily_load():
         fetch_and_store_data(f"Germany-{tso_name}", control_area, period_start, period_end)
     fetch_and_store_dayahead_prices("BZN|DE-LU", germany_bidding_zone, period_start, period_end)
 
+# --- One-off migration: python etl.py dedupe ---
+# Deletes only rows that repeat another row in every loaded column (what re-runs left behind),
+# then builds the natural-key indexes. Rows sharing a key but differing in volume/price are
+# reported and kept; that table's index stays unbuilt until they are reviewed by hand
+def dedupe_tables():
+    conn = get_conn()
+    try:
+        cursor = conn.cursor()
+        for table, column_types in (("entsoe_load_data", ENTSOE_COLUMN_TYPES),
+                                    ("day_ahead_prices", DAYAHEAD_COLUMN_TYPES)):
+            index_name, key = NATURAL_KEYS[table]
+            target = sql.Identifier(table)
+            # PARTITION BY groups NULLs together, so NULL columns still count as equal
+            columns = sql.SQL(", ").join(map(sql.Identifier, column_types))
+            cursor.execute(sql.SQL("""
+            DELETE FROM {} WHERE ctid IN (
+                SELECT ctid FROM (
+                    SELECT ctid, row_number() OVER (PARTITION BY {} ORDER BY ctid) AS rn
+                    FROM {}
+                ) ranked WHERE rn > 1
+            )
+            """).format(target, columns, target))
+            logging.info(f"Removed {cursor.rowcount} exact duplicate rows from {table}")
+
+            conflicts = count_key_duplicates(cursor, table, key)
+            if conflicts:
+                conn.commit()
+                logging.error(f"{table} still has {conflicts} rows sharing a natural key with different values; "
+                              f"{index_name} not built, review them before adding it")
+                continue
+            cursor.execute(sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})").format(
+                sql.Identifier(index_name), target, natural_key_sql(key)))
+            conn.commit()
+            logging.info(f"Built {index_name}")
+        cursor.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        put_conn(conn)
+
 # --- Entry ---
 if __name__ == "__main__":
     try:
-        last_run_file = ".last_historical_run"
-        if not os.path.exists(last_run_file):
-            logging.info("Running historical backfill from Jan 1, 2024...")
-            historical_load_daywise()
-            with open(last_run_file, "w") as f:
-                f.write(datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
-
-        logging.info("Running daily load...")
-        daily_load()
-        logging.info("ETL completed successfully.")
+        if sys.argv[1:] == ["dedupe"]:
+            logging.info("Running dedupe migration...")
+            dedupe_tables()
+        else:
+            # A backfill failure must not cost the regular daily load
+            try:
+                historical_load_daywise()
+            except Exception as e:
+                logging.error(f"Historical backfill failed: {e}", exc_info=True)
+                send_email_alert("ENTSOE Historical ETL Failed", str(e))
+
+            logging.info("Running daily load...")
+            daily_load()
+            logging.info("ETL completed successfully.")
     except Exception as e:
         logging.error(f"ETL failed: {e}", exc_info=True)
         send_email_alert("ENTSOE ETL Failed", str(e))
+    finally:
+        close_db_pool()